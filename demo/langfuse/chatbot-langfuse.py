@@ -3,34 +3,36 @@ LLM Observability Demo with Ollama, Langfuse, and OpenTelemetry
 Demonstrates comprehensive observability for LLM applications
 
 Required packages:
-pip install ollama langfuse opentelemetry-api opentelemetry-sdk \
+pip install ollama langfuse prompt_toolkit opentelemetry-api opentelemetry-sdk \
     opentelemetry-exporter-otlp-proto-http
 """
 
+import io
 import os
+import asyncio
 import time
+import queue
 import logging
-from datetime import datetime
-from typing import Optional, Dict, Any
+import functools
+import threading
+import contextvars
+from collections import deque
+from urllib.parse import urlparse
+from typing import TYPE_CHECKING, Optional, Dict, Any, NamedTuple, Tuple
 
 # LLM and Observability imports
+import httpx
 import ollama
-from langfuse import observe
+from langfuse import get_client, observe
+from prompt_toolkit import PromptSession
 
-# OpenTelemetry imports
+# langfuse already loads the trace SDK; the gRPC OTLP exporters and the metrics
+# SDK are imported lazily in setup_opentelemetry()
 from opentelemetry import trace, metrics
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.semconv.resource import ResourceAttributes
-
-# HTTP exporters for OTLP
-#from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-#from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+if TYPE_CHECKING:
+    from opentelemetry.exporter.otlp.proto.grpc.exporter import Compression
 
 # Configure logging
 logging.basicConfig(
@@ -57,16 +59,152 @@ os.environ.setdefault("OTEL_EXPORTER_OTLP_TRACES_PROTOCOL", "grpc")
 os.environ.setdefault("OTEL_EXPORTER_OTLP_METRICS_PROTOCOL", "grpc")
 OTEL_COLLECTOR_ENDPOINT = os.getenv("OTEL_COLLECTOR_ENDPOINT", "http://localhost:4317")
 
+# BatchSpanProcessor tuning for low-volume interactive chat traffic.
+# A 1s schedule delay costs a little more CPU than the 5s SDK default but
+# makes traces show up in Langfuse ~5x sooner.
+OTEL_BSP_MAX_QUEUE_SIZE = int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096"))
+OTEL_BSP_SCHEDULE_DELAY = int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000"))
+OTEL_BSP_MAX_EXPORT_BATCH_SIZE = int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256"))
+OTEL_BSP_EXPORT_TIMEOUT = int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000"))
+
+# OTLP compression ("gzip" or "none"). Unset means gzip for remote collectors
+# and none on loopback, where compressing costs more CPU than it saves.
+OTEL_EXPORTER_OTLP_COMPRESSION = os.getenv("OTEL_EXPORTER_OTLP_COMPRESSION")
+
+# Metrics are exported on a slow idle interval and flushed after each chat turn
+OTEL_METRIC_EXPORT_INTERVAL = int(os.getenv("OTEL_METRIC_EXPORT_INTERVAL", "30000"))
+OTEL_METRIC_FLUSH_TIMEOUT = 500
+
+# How long to wait for the collector at startup before giving up on OTLP export
+OTEL_COLLECTOR_PROBE_TIMEOUT = float(os.getenv("OTEL_COLLECTOR_PROBE_TIMEOUT", "2"))
+
+# Fraction of new traces to sample; child spans follow their parent's decision
+OTEL_SAMPLE_RATIO = float(os.getenv("OTEL_SAMPLE_RATIO", "1.0"))
+
 # Ollama Configuration
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+# Keep the connection to Ollama open between turns so each request skips the TCP handshake
+OLLAMA_KEEPALIVE_CONNECTIONS = 4
+OLLAMA_KEEPALIVE_EXPIRY = 60.0
+
+# Chat Configuration
+# Only the most recent messages are resent to the model so prompt size stays
+# constant instead of growing with every turn.
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "16"))
+CHAT_SYSTEM_PROMPT = os.getenv("CHAT_SYSTEM_PROMPT", "You are a helpful assistant.")
+
+# Smoothing factor for the inter-token latency moving average
+INTER_TOKEN_EMA_ALPHA = 0.2
 
 # ============================================================================
 # OpenTelemetry Setup
 # ============================================================================
 
+class QueueingSpanExporter(SpanExporter):
+    """Span exporter that hands batches to a background worker thread
+
+    export() only enqueues, so a slow or unreachable collector never blocks
+    span flushing. When the queue is full the batch is dropped and counted
+    instead of back-pressuring chat().
+
+    BatchSpanProcessor.force_flush() never reaches the exporter, so queued
+    batches are only guaranteed to be sent by shutdown(), which drains the
+    queue before stopping the worker.
+    """
+
+    def __init__(self, exporter: SpanExporter, max_queue_size: int = 4096):
+        self._exporter = exporter
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._worker = threading.Thread(
+            target=self._run, name="otlp-span-export", daemon=True
+        )
+        self._worker.start()
+
+    def export(self, spans) -> SpanExportResult:
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            get_llm_metrics().error_counter.add(len(spans), {"reason": "span_dropped"})
+        return SpanExportResult.SUCCESS
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            try:
+                if spans is None:
+                    return
+                self._exporter.export(spans)
+            except Exception as e:
+                logger.debug("Span export failed: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self):
+        try:
+            self._queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+        self._worker.join(timeout=5)
+        self._exporter.shutdown()
+
+
+def split_otlp_endpoint(endpoint: str) -> Tuple[str, str, Optional[str]]:
+    """Split an OTLP endpoint into (scheme, host:port target, hostname).
+
+    The gRPC exporter also accepts a bare "host:port", which urlparse would read
+    as scheme "host", so the scheme is only parsed when "://" is present.
+    """
+    url = urlparse(endpoint if "://" in endpoint else f"//{endpoint}")
+    return url.scheme, url.netloc, url.hostname
+
+
+def get_otlp_compression(endpoint: str) -> "Compression":
+    """Pick the gRPC compression for the OTLP exporters"""
+    from opentelemetry.exporter.otlp.proto.grpc.exporter import Compression
+
+    setting = OTEL_EXPORTER_OTLP_COMPRESSION
+    if setting is None:
+        _, _, host = split_otlp_endpoint(endpoint)
+        setting = "none" if host in ("localhost", "127.0.0.1", "::1") else "gzip"
+    return Compression.Gzip if setting.lower() == "gzip" else Compression.NoCompression
+
+
+@functools.lru_cache(maxsize=None)
+def collector_reachable(endpoint: str, timeout: float = OTEL_COLLECTOR_PROBE_TIMEOUT) -> bool:
+    """Check once whether the OTLP gRPC collector accepts connections"""
+    import grpc
+
+    scheme, target, _ = split_otlp_endpoint(endpoint)
+    if scheme == "https":
+        channel = grpc.secure_channel(target, grpc.ssl_channel_credentials())
+    else:
+        channel = grpc.insecure_channel(target)
+    try:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+        return True
+    except grpc.FutureTimeoutError:
+        return False
+    finally:
+        channel.close()
+
+
+@functools.lru_cache(maxsize=None)
 def setup_opentelemetry():
-    """Initialize OpenTelemetry with OTLP HTTP exporters"""
+    """Initialize OpenTelemetry with OTLP HTTP exporters (once, on first use)"""
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.semconv.resource import ResourceAttributes
+
+    # HTTP exporters for OTLP
+    #from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    #from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
     
     # Create resource
     resource = Resource.create({
@@ -78,30 +216,54 @@ def setup_opentelemetry():
     # Ensure endpoint has http:// prefix but NO path
     endpoint = OTEL_COLLECTOR_ENDPOINT
         
+    compression = get_otlp_compression(endpoint)
+    
     logger.info(f"Configuring OpenTelemetry with HTTP endpoint: {endpoint}")
     
+    # Without a collector the OTLP exporters would only burn CPU on retries and
+    # stall exports, so leave them out entirely
+    export_enabled = collector_reachable(endpoint)
+    if not export_enabled:
+        logger.warning(
+            f"OTLP collector at {endpoint} is unreachable; spans and metrics will not be exported"
+        )
+    
     try:
         # Setup Tracing with HTTP exporter
-        trace_provider = TracerProvider(resource=resource)
-                 
-        otlp_trace_exporter = OTLPSpanExporter(
-            endpoint=endpoint,
+        trace_provider = TracerProvider(
+            resource=resource,
+            sampler=ParentBased(TraceIdRatioBased(OTEL_SAMPLE_RATIO)),
         )
-        trace_provider.add_span_processor(BatchSpanProcessor(otlp_trace_exporter))
+        
+        if export_enabled:
+            otlp_trace_exporter = OTLPSpanExporter(
+                endpoint=endpoint,
+                compression=compression,
+            )
+            trace_provider.add_span_processor(BatchSpanProcessor(
+                QueueingSpanExporter(otlp_trace_exporter),
+                max_queue_size=OTEL_BSP_MAX_QUEUE_SIZE,
+                schedule_delay_millis=OTEL_BSP_SCHEDULE_DELAY,
+                max_export_batch_size=OTEL_BSP_MAX_EXPORT_BATCH_SIZE,
+                # No effect: QueueingSpanExporter.export() returns without waiting on the collector
+                export_timeout_millis=OTEL_BSP_EXPORT_TIMEOUT,
+            ))
+            logger.info(f"✓ Trace exporter configured")
         trace.set_tracer_provider(trace_provider)
-        logger.info(f"✓ Trace exporter configured")
-       
-         
-        otlp_metric_exporter = OTLPMetricExporter(
-            endpoint=endpoint,
-        )
-        metric_reader = PeriodicExportingMetricReader(
-            otlp_metric_exporter, 
-            export_interval_millis=10000
-        )
-        meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
+        
+        metric_readers = []
+        if export_enabled:
+            otlp_metric_exporter = OTLPMetricExporter(
+                endpoint=endpoint,
+                compression=compression,
+            )
+            metric_readers.append(PeriodicExportingMetricReader(
+                otlp_metric_exporter, 
+                export_interval_millis=OTEL_METRIC_EXPORT_INTERVAL
+            ))
+            logger.info(f"✓ Metric exporter configured")
+        meter_provider = MeterProvider(resource=resource, metric_readers=metric_readers)
         metrics.set_meter_provider(meter_provider)
-        logger.info(f"✓ Metric exporter configured")
         
         logger.info("OpenTelemetry configured successfully with HTTP protocol")
         
@@ -111,48 +273,144 @@ def setup_opentelemetry():
     
     return trace.get_tracer(__name__), metrics.get_meter(__name__)
 
-# Initialize OpenTelemetry
-tracer, meter = setup_opentelemetry()
 
-# Create custom metrics
-llm_request_counter = meter.create_counter(
-    name="llm.requests.total",
-    description="Total number of LLM requests",
-    unit="1"
-)
+def flush_metrics_async():
+    """Export pending metrics on a background thread without blocking the caller"""
+    # No metric readers are installed when the collector was unreachable at startup
+    if not collector_reachable(OTEL_COLLECTOR_ENDPOINT):
+        return
+    flush = threading.Timer(
+        0,
+        metrics.get_meter_provider().force_flush,
+        kwargs={"timeout_millis": OTEL_METRIC_FLUSH_TIMEOUT},
+    )
+    flush.daemon = True
+    flush.start()
 
-llm_token_counter = meter.create_counter(
-    name="llm.tokens.total",
-    description="Total number of tokens processed",
-    unit="1"
-)
 
-llm_latency_histogram = meter.create_histogram(
-    name="llm.request.duration",
-    description="LLM request duration",
-    unit="ms"
-)
+class TokenTotals:
+    """Cumulative token counts, read by an observable counter at export time
 
-llm_error_counter = meter.create_counter(
-    name="llm.errors.total",
-    description="Total number of LLM errors",
-    unit="1"
-)
+    Chat turns only bump plain ints; the metric SDK aggregates once per
+    export interval instead of on every request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[tuple, int] = {}
+
+    def add(self, model: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            prompt_key = (model, "prompt")
+            completion_key = (model, "completion")
+            self._totals[prompt_key] = self._totals.get(prompt_key, 0) + prompt_tokens
+            self._totals[completion_key] = self._totals.get(completion_key, 0) + completion_tokens
+
+    def observe(self, options):
+        with self._lock:
+            totals = list(self._totals.items())
+        return [
+            metrics.Observation(value, {"model": model, "type": token_type})
+            for (model, token_type), value in totals
+        ]
+
+
+class LLMMetrics(NamedTuple):
+    """Custom OpenTelemetry instruments for the chatbot"""
+    request_counter: Any
+    token_totals: TokenTotals
+    latency_histogram: Any
+    error_counter: Any
+    ttft_histogram: Any
+    inter_token_histogram: Any
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_metrics() -> LLMMetrics:
+    """Create the custom metrics once, initializing OpenTelemetry if needed"""
+    _, meter = setup_opentelemetry()
+    
+    token_totals = TokenTotals()
+    meter.create_observable_counter(
+        name="llm.tokens.total",
+        callbacks=[token_totals.observe],
+        description="Total number of tokens processed",
+        unit="1"
+    )
+    
+    return LLMMetrics(
+        request_counter=meter.create_counter(
+            name="llm.requests.total",
+            description="Total number of LLM requests",
+            unit="1"
+        ),
+        token_totals=token_totals,
+        latency_histogram=meter.create_histogram(
+            name="llm.request.duration",
+            description="LLM request duration",
+            unit="ms"
+        ),
+        error_counter=meter.create_counter(
+            name="llm.errors.total",
+            description="Total number of LLM errors",
+            unit="1"
+        ),
+        ttft_histogram=meter.create_histogram(
+            name="llm.time_to_first_token_ms",
+            description="Time until the first streamed token arrives",
+            unit="ms"
+        ),
+        inter_token_histogram=meter.create_histogram(
+            name="llm.inter_token_latency_ms",
+            description="Moving average of the delay between streamed tokens",
+            unit="ms"
+        ),
+    )
 
 # ============================================================================
 # LLM Chatbot Class
 # ============================================================================
 
+@functools.lru_cache(maxsize=1)
+def get_ollama_client() -> ollama.Client:
+    """Get the shared Ollama client; httpx clients are thread-safe, so every chatbot reuses one pool"""
+    return ollama.Client(
+        host=OLLAMA_HOST,
+        transport=httpx.HTTPTransport(
+            retries=0,
+            limits=httpx.Limits(
+                max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+            ),
+        ),
+    )
+
+
+class ChatMessage:
+    """Single conversation turn; slotted to keep long histories small"""
+    __slots__ = ("role", "content")
+    
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+
+
 class ObservableChatbot:
     """Chatbot with comprehensive observability using Langfuse and OpenTelemetry"""
     
     def __init__(self, model: str = OLLAMA_MODEL):
         self.model = model
-        self.conversation_history = []
-        self.ollama_client = ollama.Client(host=OLLAMA_HOST)
+        self.system_message = {"role": "system", "content": CHAT_SYSTEM_PROMPT}
+        self.conversation_history = deque(maxlen=CHAT_HISTORY_TURNS)
+        self.metrics = get_llm_metrics()
+        self.langfuse = get_client()
+        # Metric attribute sets are fixed per model, so build them once
+        self._attrs_model = {"model": model}
+        self._attrs_success = {"model": model, "status": "success"}
+        self._attrs_error = {"model": model, "status": "error"}
+        self.ollama_client = get_ollama_client()
         logger.info(f"Initialized chatbot with model: {model}")
     
-    @observe(name="chat_completion", as_type="generation")
     def chat(self, user_message: str, session_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Send a message and get a response with full observability
@@ -164,54 +422,72 @@ class ObservableChatbot:
         Returns:
             Dictionary containing response and metadata
         """
-        start_time = time.time()
+        start_ns = time.perf_counter_ns()
         
-        with tracer.start_as_current_span("llm_chat_request") as span:
-            span.set_attribute("llm.model", self.model)
-            span.set_attribute("llm.user_message_length", len(user_message))
-            if session_id:
-                span.set_attribute("session.id", session_id)
+        # Open the Langfuse generation directly rather than through the @observe
+        # wrapper, which introspects the call signature on every invocation
+        with self.langfuse.start_as_current_generation(
+            name="chat_completion", model=self.model, input=user_message
+        ) as generation:
+            span = trace.get_current_span()
+            # Skip building attributes for spans the sampler dropped
+            recording = span.is_recording()
+            # Span attributes are collected here and applied with one set_attributes() call
+            if recording:
+                attrs = {
+                    "llm.model": self.model,
+                    "llm.user_message_length": len(user_message),
+                }
+                if session_id:
+                    attrs["session.id"] = session_id
             
             try:
                 # Add user message to history
-                self.conversation_history.append({
-                    "role": "user",
-                    "content": user_message
-                })
+                self.conversation_history.append(ChatMessage("user", user_message))
                 
-                logger.info(f"Processing message: {user_message[:50]}...")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Processing message: %s...", user_message[:50])
                 
                 # Call Ollama with observability
                 response = self._call_ollama(user_message)
                 
                 # Add assistant response to history
-                self.conversation_history.append({
-                    "role": "assistant",
-                    "content": response["content"]
-                })
+                self.conversation_history.append(ChatMessage("assistant", response["content"]))
                 
                 # Calculate metrics
-                duration_ms = (time.time() - start_time) * 1000
+                duration_ms = (time.perf_counter_ns() - start_ns) / 1_000_000
                 total_tokens = response.get("total_tokens", 0)
                 
-                # Update OpenTelemetry metrics
-                llm_request_counter.add(1, {"model": self.model, "status": "success"})
-                llm_token_counter.add(total_tokens, {"model": self.model, "type": "total"})
-                llm_latency_histogram.record(duration_ms, {"model": self.model})
+                # Update OpenTelemetry metrics (token totals are sum(llm.tokens.total) over type)
+                self.metrics.request_counter.add(1, self._attrs_success)
+                self.metrics.latency_histogram.record(duration_ms, self._attrs_model)
                 
                 # Set span attributes
-                span.set_attribute("llm.response_length", len(response["content"]))
-                span.set_attribute("llm.total_tokens", total_tokens)
-                span.set_attribute("llm.duration_ms", duration_ms)
-                span.set_attribute("llm.status", "success")
+                if recording:
+                    attrs["llm.response_length"] = len(response["content"])
+                    attrs["llm.total_tokens"] = total_tokens
+                    attrs["llm.duration_ms"] = duration_ms
+                    attrs["llm.status"] = "success"
+                    span.set_attributes(attrs)
+                    generation.update(
+                        output=response["content"],
+                        usage_details={
+                            "input": response.get("prompt_eval_count", 0),
+                            "output": response.get("eval_count", 0),
+                        },
+                    )
                 
-                logger.info(f"Response generated in {duration_ms:.2f}ms with {total_tokens} tokens")
+                logger.info("Response generated in %.2fms with %d tokens", duration_ms, total_tokens)
+                
+                # Push this turn's metrics now rather than waiting for the next export interval
+                flush_metrics_async()
                 
                 return {
                     "response": response["content"],
                     "metadata": {
                         "model": self.model,
                         "duration_ms": duration_ms,
+                        "first_token_ms": response.get("first_token_ms"),
                         "total_tokens": total_tokens,
                         "prompt_tokens": response.get("prompt_eval_count", 0),
                         "completion_tokens": response.get("eval_count", 0),
@@ -220,19 +496,22 @@ class ObservableChatbot:
                 }
                 
             except Exception as e:
-                duration_ms = (time.time() - start_time) * 1000
+                duration_ms = (time.perf_counter_ns() - start_ns) / 1_000_000
+                err_type = type(e).__name__
                 
                 # Update error metrics
-                llm_error_counter.add(1, {"model": self.model, "error_type": type(e).__name__})
-                llm_request_counter.add(1, {"model": self.model, "status": "error"})
+                self.metrics.error_counter.add(1, {"model": self.model, "error_type": err_type})
+                self.metrics.request_counter.add(1, self._attrs_error)
                 
-                # Update span with error
-                span.set_attribute("llm.status", "error")
-                span.set_attribute("error.type", type(e).__name__)
-                span.set_attribute("error.message", str(e))
-                span.record_exception(e)
+                # Update span with error; the generation context manager
+                # records the exception itself when it is re-raised
+                if recording:
+                    attrs["llm.status"] = "error"
+                    attrs["error.type"] = err_type
+                    attrs["error.message"] = str(e)
+                    span.set_attributes(attrs)
                 
-                logger.error(f"Error in chat: {str(e)}", exc_info=True)
+                logger.error("Error in chat: %s", e, exc_info=True)
                 
                 raise
     
@@ -240,54 +519,122 @@ class ObservableChatbot:
     def _call_ollama(self, message: str) -> Dict[str, Any]:
         """Make API call to Ollama with observability"""
         
-        with tracer.start_as_current_span("ollama_api") as span:
-            try:
-                response = self.ollama_client.chat(
-                    model=self.model,
-                    messages=self.conversation_history,
-                )
-                
-                # Extract token counts
-                prompt_tokens = response.get("prompt_eval_count", 0)
-                completion_tokens = response.get("eval_count", 0)
-                total_tokens = prompt_tokens + completion_tokens
-                
-                span.set_attribute("llm.prompt_tokens", prompt_tokens)
-                span.set_attribute("llm.completion_tokens", completion_tokens)
-                span.set_attribute("llm.total_tokens", total_tokens)
-                
-                # Update token metrics
-                llm_token_counter.add(prompt_tokens, {"model": self.model, "type": "prompt"})
-                llm_token_counter.add(completion_tokens, {"model": self.model, "type": "completion"})
-                
-                return {
-                    "content": response["message"]["content"],
-                    "total_tokens": total_tokens,
-                    "prompt_eval_count": prompt_tokens,
-                    "eval_count": completion_tokens
+        # Reuse the span opened by @observe instead of nesting another one
+        span = trace.get_current_span()
+        try:
+            start_ns = time.perf_counter_ns()
+            stream = self.ollama_client.chat(
+                model=self.model,
+                messages=[
+                    self.system_message,
+                    *({"role": m.role, "content": m.content} for m in self.conversation_history),
+                ],
+                stream=True,
+            )
+            
+            # Collect streamed chunks, timing the first token and the gaps between tokens
+            content = io.StringIO()
+            response = {}
+            first_token_ms = None
+            inter_token_ms = None
+            last_chunk_ns = start_ns
+            for response in stream:
+                now_ns = time.perf_counter_ns()
+                if first_token_ms is None:
+                    first_token_ms = (now_ns - start_ns) / 1_000_000
+                else:
+                    gap_ms = (now_ns - last_chunk_ns) / 1_000_000
+                    inter_token_ms = gap_ms if inter_token_ms is None else (
+                        INTER_TOKEN_EMA_ALPHA * gap_ms
+                        + (1 - INTER_TOKEN_EMA_ALPHA) * inter_token_ms
+                    )
+                last_chunk_ns = now_ns
+                content.write(response["message"]["content"])
+            
+            # Token counts are reported on the final chunk
+            prompt_tokens = response.get("prompt_eval_count", 0)
+            completion_tokens = response.get("eval_count", 0)
+            total_tokens = prompt_tokens + completion_tokens
+            
+            if span.is_recording():
+                attrs = {
+                    "llm.prompt_tokens": prompt_tokens,
+                    "llm.completion_tokens": completion_tokens,
+                    "llm.total_tokens": total_tokens,
                 }
-                
-            except Exception as e:
-                span.record_exception(e)
-                logger.error(f"Ollama API error: {str(e)}")
-                raise
+                if first_token_ms is not None:
+                    attrs["llm.first_token_ms"] = first_token_ms
+                span.set_attributes(attrs)
+            
+            # Update token metrics
+            self.metrics.token_totals.add(self.model, prompt_tokens, completion_tokens)
+            
+            # Update streaming latency metrics
+            if first_token_ms is not None:
+                self.metrics.ttft_histogram.record(first_token_ms, self._attrs_model)
+            if inter_token_ms is not None:
+                self.metrics.inter_token_histogram.record(inter_token_ms, self._attrs_model)
+            
+            return {
+                "content": content.getvalue(),
+                "first_token_ms": first_token_ms,
+                "total_tokens": total_tokens,
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": completion_tokens
+            }
+            
+        except Exception as e:
+            # The @observe span records the exception as it propagates
+            logger.error("Ollama API error: %s", e)
+            raise
     
     def clear_history(self):
         """Clear conversation history"""
-        self.conversation_history = []
+        self.conversation_history.clear()
         logger.info("Conversation history cleared")
     
     def get_history(self):
         """Get conversation history"""
-        return self.conversation_history
+        return list(self.conversation_history)
 
 
 # ============================================================================
 # Demo Application
 # ============================================================================
 
+def run_in_daemon_thread(func, *args, **kwargs) -> asyncio.Future:
+    """Run a blocking call on a daemon thread and await its result.
+
+    Unlike asyncio.to_thread, interpreter exit does not wait for the thread, so
+    Ctrl-C during a response exits immediately instead of waiting for Ollama to finish.
+    The caller's context is copied so the call stays inside the active trace.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    ctx = contextvars.copy_context()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def worker():
+        try:
+            result = ctx.run(func, *args, **kwargs)
+        except BaseException as e:
+            outcome = (future.set_exception, e)
+        else:
+            outcome = (future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(resolve, *outcome)
+        except RuntimeError:
+            pass  # the event loop has already shut down
+
+    threading.Thread(target=worker, name="chat-request", daemon=True).start()
+    return future
+
+
 @observe(name="chatbot_session")
-def run_demo():
+async def run_demo():
     """Run interactive demo with observability"""
     
     print("=" * 70)
@@ -306,13 +653,15 @@ def run_demo():
     
     # Initialize chatbot
     chatbot = ObservableChatbot(model=OLLAMA_MODEL)
-    session_id = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    session_id = f"session_{time.time_ns():x}"
     
     logger.info(f"Started demo session: {session_id}")
     
+    prompt_session = PromptSession()
+    
     while True:
         try:
-            user_input = input("\n🧑 You: ").strip()
+            user_input = (await prompt_session.prompt_async("\n🧑 You: ")).strip()
             
             if not user_input:
                 continue
@@ -329,12 +678,13 @@ def run_demo():
             if user_input.lower() == 'history':
                 print("\n📜 Conversation History:")
                 for i, msg in enumerate(chatbot.get_history(), 1):
-                    role = "🧑 You" if msg["role"] == "user" else "🤖 Bot"
-                    print(f"{i}. {role}: {msg['content'][:100]}...")
+                    role = "🧑 You" if msg.role == "user" else "🤖 Bot"
+                    print(f"{i}. {role}: {msg.content[:100]}...")
                 continue
             
-            # Get response with observability
-            result = chatbot.chat(user_input, session_id=session_id)
+            # Get response with observability; run in a worker thread so the
+            # event loop stays responsive
+            result = await run_in_daemon_thread(chatbot.chat, user_input, session_id=session_id)
             
             # Display response
             print(f"\n🤖 Bot: {result['response']}")
@@ -344,7 +694,8 @@ def run_demo():
                   f"(prompt: {result['metadata']['prompt_tokens']}, "
                   f"completion: {result['metadata']['completion_tokens']})")
             
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError, asyncio.CancelledError):
+            # asyncio.run delivers Ctrl-C during a response as a cancellation
             print("\n\n👋 Goodbye!")
             break
         except Exception as e:
@@ -356,4 +707,9 @@ def run_demo():
 
 
 if __name__ == "__main__":
-    run_demo()
\ No newline at end of file
+    # Configure OpenTelemetry before Langfuse's @observe sets up its own provider
+    setup_opentelemetry()
+    try:
+        asyncio.run(run_demo())
+    except KeyboardInterrupt:
+        print("\n\n👋 Goodbye!")
\ No newline at end of file
@@ -3,83 +3,272 @@ Complete LLM Observability Demo with Langfuse + OpenTelemetry
 Works with Ollama and sends traces to multiple backends
 """
 
-from openai import OpenAI
+import httpx
+import orjson
+from openai import AsyncOpenAI, OpenAI
 from opentelemetry import trace, metrics
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.metrics import Counter, MeterProvider
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from opentelemetry.sdk.metrics.export import AggregationTemporality, PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import Resource
+import logging
+import os
 import time
+import asyncio
+import atexit
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from types import MappingProxyType
 from traceloop.sdk import Traceloop
 from traceloop.sdk.decorators import workflow
 from traceloop.sdk.tracing.manual import LLMMessage, LLMUsage, track_llm_call
 
 # Configuration
-OLLAMA_BASE_URL = "http://localhost:11434/v1"
+OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_BASE_URL = f"{OLLAMA_HOST}/v1"
+# How long Ollama keeps the warmed-up model in memory
+OLLAMA_KEEP_ALIVE = "5m"
 OTEL_ENDPOINT = "http://localhost:4318"
 DEFAULT_MODEL = "llama3.1:8b"
+SERVICE_NAME = "ollama-demo-agent"
+
+# Span batching tuned for low-volume interactive chat: chat() only enqueues
+# spans, and a 1s schedule delay (SDK default 5s) gets traces to the backend sooner
+BSP_MAX_QUEUE_SIZE = int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096"))
+BSP_MAX_EXPORT_BATCH_SIZE = int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256"))
+BSP_SCHEDULE_DELAY_MILLIS = int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000"))
+METRIC_EXPORT_INTERVAL_MILLIS = 30000
+
+# TRACING_ENABLED=0 binds chat() to a bare Ollama call with no spans or metrics
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") != "0"
+
+logger = logging.getLogger(__name__)
+
+# Exact-match cache for deterministic (temperature=0) requests
+RESPONSE_CACHE_SIZE = 256
+
+# Idle connections kept open to Ollama, shared by every agent in the process
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = 32
+
+# Keep this byte-identical across calls: Ollama reuses the KV cache of a shared
+# prompt prefix, so an unchanged system message is only evaluated once per model load
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+
+def response_cache_key(model, messages, temperature, max_tokens):
+    """Hash everything that determines a temperature=0 completion"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+# Async connection pools are bound to the event loop that opened them, so
+# agents share one client per running loop rather than one per process
+_clients = weakref.WeakKeyDictionary()
+
+
+def _get_client():
+    """Get the Ollama client for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncOpenAI(
+            base_url=OLLAMA_BASE_URL,
+            api_key="ollama",
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS)
+            ),
+        )
+    return client
+
+
+async def close_client():
+    """Close the running loop's client; await before the loop shuts down"""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
 
 #export TRACELOOP_BASE_URL="http://localhost:4317"                     
 #export OTEL_EXPORTER_OTLP_ENDPOINT="http://localhost:4317"
 
+# Setup Metrics once per process so every agent shares one exporter.
+# Counters are exported as deltas, which keeps each payload small.
+metric_reader = PeriodicExportingMetricReader(
+    OTLPMetricExporter(
+        endpoint=f"{OTEL_ENDPOINT}/v1/metrics",
+        preferred_temporality={Counter: AggregationTemporality.DELTA},
+    ),
+    export_interval_millis=METRIC_EXPORT_INTERVAL_MILLIS
+)
+meter_provider = MeterProvider(
+    resource=Resource.create({"service.name": SERVICE_NAME}),
+    metric_readers=[metric_reader]
+)
+metrics.set_meter_provider(meter_provider)
+meter = metrics.get_meter(__name__)
+
+# Create custom metrics
+request_counter = meter.create_counter(
+    "llm_requests_total",
+    description="Total number of LLM requests"
+)
+token_counter = meter.create_counter(
+    "llm_tokens_total",
+    description="Total tokens used"
+)
+latency_histogram = meter.create_histogram(
+    "llm_request_duration",
+    description="LLM request duration in seconds",
+    unit="s"
+)
+ttft_histogram = meter.create_histogram(
+    "llm.time_to_first_token_ms",
+    description="Time until the first streamed token arrives",
+    unit="ms"
+)
+
 class LLMObservabilityAgent:
     """Agent with built-in observability using OpenTelemetry"""
     
-    def __init__(self, service_name="ollama-demo-agent"):
-        # Setup OpenTelemetry
-        resource = Resource.create({"service.name": service_name})
+    def __init__(self, service_name=SERVICE_NAME):
         # keep service name for metric attributes
         self.service_name = service_name
 
-                # Initialize OpenLLMetry instrumentation for Ollama
-        Traceloop.init(
-            app_name="openllmetry-ollama-chatbot",
-            disable_batch=True,  # For local development to see traces immediately
-            api_key="local-dev-key",  # Use local dev key for local Traceloop instance
-            #endpoint=TRACELOOP_BASE_URL
-        )
-        
-        # Setup Tracing
-        trace_provider = TracerProvider(resource=resource)
-        #(endpoint=OTEL_ENDPOINT, insecure=True)
-        #trace_provider.add_span_processor(BatchSpanProcessor(otlp_exporter))
-        #trace.set_tracer_provider(trace_provider)
-        #self.tracer = trace.get_tracer(__name__)
-        
-        # Setup Metrics
-        metric_reader = PeriodicExportingMetricReader(
-            OTLPMetricExporter(endpoint=OTEL_ENDPOINT)
-        )
-        meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
-        metrics.set_meter_provider(meter_provider)
-        meter = metrics.get_meter(__name__)
+        # Load the model in the background so it overlaps with instrumentation setup
+        print("⏳ warming model…")
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+        # Pick the chat implementation once so the hot path has no per-call branch
+        self.chat = self._chat_instrumented if TRACING_ENABLED else self._chat_raw
+        self.span_processor = None
+
+        if TRACING_ENABLED:
+            # Setup Tracing: batch spans so export never blocks the LLM call
+            self.span_processor = BatchSpanProcessor(
+                OTLPSpanExporter(endpoint=f"{OTEL_ENDPOINT}/v1/traces"),
+                max_queue_size=BSP_MAX_QUEUE_SIZE,
+                max_export_batch_size=BSP_MAX_EXPORT_BATCH_SIZE,
+                schedule_delay_millis=BSP_SCHEDULE_DELAY_MILLIS,
+            )
+            #self.tracer = trace.get_tracer(__name__)
+
+            # Initialize OpenLLMetry instrumentation for Ollama
+            Traceloop.init(
+                app_name="openllmetry-ollama-chatbot",
+                disable_batch=False,
+                api_key="local-dev-key",  # Use local dev key for local Traceloop instance
+                processor=self.span_processor,
+                #endpoint=TRACELOOP_BASE_URL
+            )
         
-        # Create custom metrics
-        self.request_counter = meter.create_counter(
-            "llm_requests_total",
-            description="Total number of LLM requests"
-        )
-        self.token_counter = meter.create_counter(
-            "llm_tokens_total",
-            description="Total tokens used"
-        )
-        self.latency_histogram = meter.create_histogram(
-            "llm_request_duration",
-            description="LLM request duration in seconds",
-            unit="s"
-        )
+        # Shared process-wide metrics
+        self.request_counter = request_counter
+        self.token_counter = token_counter
+        self.latency_histogram = latency_histogram
+        self.ttft_histogram = ttft_histogram
         
-        # Initialize Ollama client
-        self.client = OpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama")
+        self._cache = OrderedDict()
+        self._attrs_by_model = {}
+        self._system_msg = {"role": "system", "content": SYSTEM_PROMPT}
         
         print(f"✅ {service_name} initialized with observability")
         print(f"📊 Sending traces to: {OTEL_ENDPOINT}")
     
-    def chat(self, prompt: str, model: str = DEFAULT_MODEL, **kwargs):
+    def _warm_up(self, model: str = DEFAULT_MODEL):
+        """Ask Ollama to load the model without generating anything"""
+        # Native endpoint over plain httpx: the OpenAI SDK is instrumented by
+        # Traceloop and would export a fake LLM span for the warm-up
+        try:
+            httpx.post(
+                f"{OLLAMA_HOST}/api/generate",
+                json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=None,
+            ).raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning("Model warm-up failed: %s", e)
+    
+    @property
+    def client(self):
+        """Shared Ollama client for the current event loop (async so concurrent queries overlap)"""
+        return _get_client()
+    
+    def _metric_attrs(self, model):
+        """Read-only metric attribute sets for a model, built on first use"""
+        attrs = self._attrs_by_model.get(model)
+        if attrs is None:
+            base = {"model": model, "service": self.service_name}
+            attrs = self._attrs_by_model[model] = {
+                "base": MappingProxyType(base),
+                "success": MappingProxyType({**base, "status": "success"}),
+                "error": MappingProxyType({**base, "status": "error"}),
+                "cache_hit": MappingProxyType({**base, "status": "cache_hit"}),
+                "tokens_total": MappingProxyType({**base, "type": "total"}),
+            }
+        return attrs
+    
+    def flush(self):
+        """Export any buffered spans and metrics"""
+        if self.span_processor is not None:
+            self.span_processor.force_flush()
+        meter_provider.force_flush()
+    
+    async def _chat_raw(self, prompt: str, model: str = DEFAULT_MODEL, **kwargs):
+        """
+        Send a chat request with no spans, metrics or caching
+        """
+        start = time.perf_counter_ns()
+        try:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=[self._system_msg, {"role": "user", "content": prompt}],
+                temperature=kwargs.get("temperature", 0.7),
+                max_tokens=kwargs.get("max_tokens", 500),
+            )
+        except Exception as e:
+            logger.error("❌ Error: %s", e)
+            return None
+        
+        usage = response.usage
+        return {
+            "content": response.choices[0].message.content,
+            "duration": (time.perf_counter_ns() - start) / 1e9,
+            "ttft": None,
+            "tokens": usage.total_tokens if usage else 0,
+            "model": model
+        }
+    
+    async def _chat_instrumented(self, prompt: str, model: str = DEFAULT_MODEL, **kwargs):
         """
         Send a chat request with full observability
         """
+        temperature = kwargs.get("temperature", 0.7)
+        max_tokens = kwargs.get("max_tokens", 500)
+        attrs = self._metric_attrs(model)
+        messages = [self._system_msg, {"role": "user", "content": prompt}]
+        
+        # Deterministic requests can be answered from the cache without calling the model
+        cache_key = None
+        if temperature == 0:
+            cache_key = response_cache_key(model, messages, temperature, max_tokens)
+            cached_content = self._cache.get(cache_key)
+            if cached_content is not None:
+                self._cache.move_to_end(cache_key)
+                self.request_counter.add(1, attrs["cache_hit"])
+                return {
+                    "content": cached_content,
+                    "duration": 0.0,
+                    "tokens": 0,
+                    "model": model
+                }
+        
         with track_llm_call(vendor="ollama", type="chat") as span:
             span.report_request(
                 model=DEFAULT_MODEL,
@@ -88,59 +277,83 @@ class LLMObservabilityAgent:
                 ],
             )
             
-            start_time = time.time()
+            start = time.perf_counter_ns()
             
             try:
                 # Make the LLM call
                 #with self.tracer.start_as_current_span("llm.completion"):
-                response = self.client.chat.completions.create(
+                stream = await self.client.chat.completions.create(
                     model=model,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=kwargs.get("temperature", 0.7),
-                    max_tokens=kwargs.get("max_tokens", 500)
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    stream_options={"include_usage": True}
                 )
                 
-                duration = time.time() - start_time
+                # Collect streamed tokens; usage totals arrive in the final chunk
+                content_parts = []
+                ttft = None
+                usage = None
+                finish_reason = None
+                response_model = model
+                async for chunk in stream:
+                    if chunk.choices:
+                        if ttft is None:
+                            ttft = (time.perf_counter_ns() - start) / 1e9
+                            self.ttft_histogram.record(ttft * 1000, attrs["base"])
+                        content_parts.append(chunk.choices[0].delta.content or "")
+                        finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    if chunk.usage:
+                        usage = chunk.usage
+                    response_model = chunk.model
+                
+                duration = (time.perf_counter_ns() - start) / 1e9
                 
                 # Extract response
-                content = response.choices[0].message.content
+                content = "".join(content_parts)
+                
+                if cache_key is not None:
+                    self._cache[cache_key] = content
+                    if len(self._cache) > RESPONSE_CACHE_SIZE:
+                        self._cache.popitem(last=False)
                 
                 # Record metrics
-                self.request_counter.add(1, {"model": model, "status": "success", "service": self.service_name})
-                self.latency_histogram.record(duration, {"model": model, "service": self.service_name})
+                self.request_counter.add(1, attrs["success"])
+                self.latency_histogram.record(duration, attrs["base"])
                 
-                if hasattr(response, 'usage') and response.usage:
-                    total_tokens = response.usage.total_tokens
-                    self.token_counter.add(
-                        total_tokens,
-                        {"model": model, "type": "total", "service": self.service_name}
-                    )
+                # Resolve the usage fields once; pydantic attribute access is not free
+                pt = ct = tt = 0
+                if usage:
+                    pt, ct, tt = usage.prompt_tokens, usage.completion_tokens, usage.total_tokens
+                    self.token_counter.add(tt, attrs["tokens_total"])
                     #span.set_attribute("llm.tokens.total", total_tokens)
                     #span.set_attribute("llm.tokens.prompt", response.usage.prompt_tokens)
                     #span.set_attribute("llm.tokens.completion", response.usage.completion_tokens)
-                    span.report_response(response.model, [text.message.content for text in response.choices])
+                    span.report_response(response_model, [content])
                     span.report_usage(
                         LLMUsage(
-                            prompt_tokens=response.usage.prompt_tokens,
-                            completion_tokens=response.usage.completion_tokens,
-                            total_tokens=total_tokens,
+                            prompt_tokens=pt,
+                            completion_tokens=ct,
+                            total_tokens=tt,
                             #=response.usage.cache_creation_input_tokens,
                             #cache_read_input_tokens=response.usage.cache_read_input_tokens,
                         )
                     )
                 
                 # Add response attributes
-                span._span.set_attribute("llm.response", content[:100])
-                span._span.set_attribute("llm.duration_ms", duration * 1000)
-                span._span.set_attribute("llm.finish_reason", response.choices[0].finish_reason)
+                otel_span = span._span
+                otel_span.set_attribute("llm.response", content[:100])
+                otel_span.set_attribute("llm.duration_ms", duration * 1000)
+                if ttft is not None:
+                    otel_span.set_attribute("llm.first_token_ms", ttft * 1000)
+                otel_span.set_attribute("llm.finish_reason", finish_reason)
                 
                 return {
                     "content": content,
                     "duration": duration,
-                    "tokens": response.usage.total_tokens if hasattr(response, 'usage') else 0,
+                    "ttft": ttft,
+                    "tokens": tt,
                     "model": model
                 }
                 
@@ -148,9 +361,9 @@ class LLMObservabilityAgent:
                 # Record error
                 span._span.set_attribute("error", True)
                 span._span.set_attribute("error.message", str(e))
-                self.request_counter.add(1, {"model": model, "status": "error", "service": self.service_name})
+                self.request_counter.add(1, attrs["error"])
                 
-                print(f"❌ Error: {e}")
+                logger.error("❌ Error: %s", e)
                 return None
 
 def run_demo():
@@ -162,6 +375,8 @@ def run_demo():
     
     # Initialize agent
     agent = LLMObservabilityAgent()
+    # Batched spans would be lost when this short-lived CLI exits
+    atexit.register(agent.flush)
     
     # Demo queries
     queries = [
@@ -189,22 +404,31 @@ def run_demo():
     
     results = []
     
-    for i, query in enumerate(queries, 1):
+    # Send all queries at once so Ollama can generate them concurrently;
+    # total wall time is the slowest query rather than the sum of all of them
+    async def run_queries():
+        try:
+            return await asyncio.gather(*(agent.chat(query["prompt"]) for query in queries))
+        finally:
+            await close_client()
+    
+    responses = asyncio.run(run_queries())
+    
+    for i, (query, result) in enumerate(zip(queries, responses), 1):
         print(f"\n📝 Query {i}/{len(queries)}: {query['prompt']}")
         print("-" * 70)
         
-        result = agent.chat(query["prompt"])
-        
         if result:
             print(f"✅ Response: {result['content']}")
             print(f"⏱️  Duration: {result['duration']:.2f}s")
+            if result.get("ttft") is not None:
+                print(f"⚡ First token: {result['ttft']:.2f}s")
             print(f"🎯 Tokens: {result['tokens']}")
             results.append(result)
         else:
             print("❌ Failed to get response")
         
         print("-" * 70)
-        time.sleep(0.5)  # Brief pause between requests
     
     # Summary
     print("\n" + "="*70)
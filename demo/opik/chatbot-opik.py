@@ -3,18 +3,26 @@ LLM Observability Demo with Ollama and Opik by Comet
 Demonstrates comprehensive observability for LLM applications
 
 Required packages:
-pip install ollama opik opentelemetry-api opentelemetry-sdk \
+pip install ollama opik numpy orjson tiktoken opentelemetry-api opentelemetry-sdk \
     opentelemetry-exporter-otlp-proto-http
 """
 
 import os
+import functools
 import time
+import hashlib
 import logging
-from datetime import datetime
+import secrets
+from collections import OrderedDict, deque
+from types import MappingProxyType
 from typing import Optional, Dict, Any
 
 # LLM imports
+import httpx
+import numpy as np
 import ollama
+import orjson
+import tiktoken
 
 # Opik imports
 import opik
@@ -23,6 +31,7 @@ from opik import configure, opik_context, track
 # OpenTelemetry imports
 from opentelemetry import trace, metrics
 from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
 from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader, ConsoleMetricExporter
@@ -50,9 +59,35 @@ OPIK_PROJECT_NAME = os.getenv("OPIK_PROJECT_NAME", "my-local-demo")
 # OpenTelemetry Configuration - HTTP endpoint (port 4318)
 OTEL_COLLECTOR_ENDPOINT = os.getenv("OTEL_COLLECTOR_ENDPOINT", "http://localhost:4318")
 
+# Span batching tuned for low-volume interactive chat: chat() only enqueues
+# spans, and a 1s schedule delay (SDK default 5s) gets traces to the backend sooner
+BSP_MAX_QUEUE_SIZE = int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096"))
+BSP_MAX_EXPORT_BATCH_SIZE = int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256"))
+BSP_SCHEDULE_DELAY_MILLIS = int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000"))
+
+# Tracing can be switched off entirely (TRACING_ENABLED=0) or sampled
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") != "0"
+OTEL_SAMPLE_RATIO = float(os.getenv("OTEL_SAMPLE_RATIO", "1.0"))
+
 # Ollama Configuration
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+# Sampling temperature; unset uses the model default. Responses are cached only at 0.
+OLLAMA_TEMPERATURE = os.getenv("OLLAMA_TEMPERATURE")
+# Idle connections kept open to Ollama so requests skip the TCP handshake
+OLLAMA_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_KEEPALIVE_CONNECTIONS", "32"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "300"))
+
+# Exact-match cache for deterministic (temperature=0) requests
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+
+# Number of most recent messages resent to the model; bounds prompt size and memory
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "20"))
+
+# Semantic cache: first-turn prompts whose embedding is this similar to a
+# cached one reuse its answer (paraphrases like "What is ML?" / "Define ML")
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
 
 # ============================================================================
 # OpenTelemetry Setup
@@ -74,29 +109,42 @@ def setup_opentelemetry():
         endpoint = f"http://{endpoint}"
     endpoint = endpoint.rstrip('/')
     
-    logger.info(f"Configuring OpenTelemetry with HTTP endpoint: {endpoint}")
-    
-    # Setup Tracing with multiple exporters
-    trace_provider = TracerProvider(resource=resource)
-    
-    # Add OTLP exporter for traces
-    traces_endpoint = f"{endpoint}/v1/traces"
-    logger.info(f"Trace endpoint: {traces_endpoint}")
+    logger.info("Configuring OpenTelemetry with HTTP endpoint: %s", endpoint)
     
-    try:
-        otlp_trace_exporter = OTLPSpanExporter(endpoint=traces_endpoint)
-        trace_provider.add_span_processor(BatchSpanProcessor(otlp_trace_exporter))
-        logger.info("✓ OTLP Trace exporter configured")
-    except Exception as e:
-        logger.warning(f"Failed to configure OTLP trace exporter: {e}")
-        logger.info("Adding console exporter as fallback")
-        trace_provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter()))
-    
-    trace.set_tracer_provider(trace_provider)
+    if TRACING_ENABLED:
+        # Setup Tracing with multiple exporters
+        trace_provider = TracerProvider(
+            resource=resource,
+            sampler=ParentBased(TraceIdRatioBased(OTEL_SAMPLE_RATIO)),
+        )
+        
+        # Add OTLP exporter for traces
+        traces_endpoint = f"{endpoint}/v1/traces"
+        logger.info("Trace endpoint: %s", traces_endpoint)
+        
+        try:
+            otlp_trace_exporter = OTLPSpanExporter(endpoint=traces_endpoint)
+            trace_provider.add_span_processor(BatchSpanProcessor(
+                otlp_trace_exporter,
+                max_queue_size=BSP_MAX_QUEUE_SIZE,
+                max_export_batch_size=BSP_MAX_EXPORT_BATCH_SIZE,
+                schedule_delay_millis=BSP_SCHEDULE_DELAY_MILLIS,
+            ))
+            logger.info("✓ OTLP Trace exporter configured")
+        except Exception as e:
+            logger.warning("Failed to configure OTLP trace exporter: %s", e)
+            logger.info("Adding console exporter as fallback")
+            trace_provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter()))
+        
+        trace.set_tracer_provider(trace_provider)
+    else:
+        # No-op provider: span creation allocates nothing
+        trace.set_tracer_provider(trace.NoOpTracerProvider())
+        logger.info("Tracing disabled (TRACING_ENABLED=0)")
     
     # Setup Metrics
     metrics_endpoint = f"{endpoint}/v1/metrics"
-    logger.info(f"Metric endpoint: {metrics_endpoint}")
+    logger.info("Metric endpoint: %s", metrics_endpoint)
     
     try:
         otlp_metric_exporter = OTLPMetricExporter(endpoint=metrics_endpoint)
@@ -107,7 +155,7 @@ def setup_opentelemetry():
         meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
         logger.info("✓ OTLP Metric exporter configured")
     except Exception as e:
-        logger.warning(f"Failed to configure OTLP metric exporter: {e}")
+        logger.warning("Failed to configure OTLP metric exporter: %s", e)
         logger.info("Adding console exporter as fallback")
         console_metric_reader = PeriodicExportingMetricReader(
             ConsoleMetricExporter(),
@@ -135,7 +183,7 @@ opik_client = opik.Opik(
     project_name=OPIK_PROJECT_NAME
 )
 
-logger.info(f"Opik configured - Project: {OPIK_PROJECT_NAME}, Workspace: {OPIK_WORKSPACE}")
+logger.info("Opik configured - Project: %s, Workspace: %s", OPIK_PROJECT_NAME, OPIK_WORKSPACE)
 
 # ============================================================================
 # Custom Metrics
@@ -165,18 +213,74 @@ llm_error_counter = meter.create_counter(
     unit="1"
 )
 
+llm_ttft_histogram = meter.create_histogram(
+    name="llm.time_to_first_token_ms",
+    description="Time until the first streamed token arrives",
+    unit="ms"
+)
+
 # ============================================================================
 # LLM Chatbot Class with Opik Tracking
 # ============================================================================
 
+def load_encoding():
+    """Local tokenizer for estimating prompt size before the request is sent.
+
+    tiktoken downloads the BPE file on a cold cache, so this runs once at startup
+    and returns None when that fails (e.g. offline) so the estimate is skipped.
+    cl100k_base is not the Llama vocabulary, so counts are approximate.
+    """
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("Token estimate disabled, could not load tokenizer: %s", e)
+        return None
+
+# The estimate is only a span attribute, so skip the tokenizer when tracing is off
+_ENC = load_encoding() if TRACING_ENABLED else None
+
+def response_cache_key(model: str, messages: list, temperature: float) -> str:
+    """Hash everything that determines a temperature=0 completion"""
+    payload = {"model": model, "messages": messages, "temperature": temperature}
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def get_ollama_client() -> ollama.Client:
+    """Get the shared Ollama client so every chatbot reuses one keep-alive pool"""
+    return ollama.Client(
+        host=OLLAMA_HOST,
+        limits=httpx.Limits(
+            max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
 class OpikObservableChatbot:
     """Chatbot with comprehensive observability using Opik and OpenTelemetry"""
     
-    def __init__(self, model: str = OLLAMA_MODEL):
+    def __init__(self, model: str = OLLAMA_MODEL, temperature: Optional[float] = None):
+        if temperature is None and OLLAMA_TEMPERATURE is not None:
+            temperature = float(OLLAMA_TEMPERATURE)
         self.model = model
-        self.conversation_history = []
-        self.ollama_client = ollama.Client(host=OLLAMA_HOST)
-        logger.info(f"Initialized chatbot with model: {model}")
+        self.temperature = temperature
+        self.conversation_history = deque(maxlen=HISTORY_WINDOW)
+        # Estimated token count per history message (None until first needed),
+        # kept in step with the window
+        self._history_tokens = deque(maxlen=HISTORY_WINDOW)
+        self.ollama_client = get_ollama_client()
+        self._cache = OrderedDict()
+        # Metric attribute sets are fixed per model, so build them once (read-only)
+        self._attrs_model = MappingProxyType({"model": model})
+        self._attrs_ok = MappingProxyType({"model": model, "status": "success"})
+        self._attrs_err = MappingProxyType({"model": model, "status": "error"})
+        self._attrs_prompt = MappingProxyType({"model": model, "type": "prompt"})
+        self._attrs_completion = MappingProxyType({"model": model, "type": "completion"})
+        # Semantic cache: normalized prompt embeddings (N, d) and their responses
+        self._emb_matrix: Optional[np.ndarray] = None
+        self._cached_responses = []
+        logger.info("Initialized chatbot with model: %s", model)
     
     @track(name="chat_completion", capture_input=True, capture_output=True)
     def chat(self, user_message: str, session_id: Optional[str] = None) -> Dict[str, Any]:
@@ -190,52 +294,55 @@ class OpikObservableChatbot:
         Returns:
             Dictionary containing response and metadata
         """
-        start_time = time.time()
+        start = time.perf_counter_ns()
         
         with tracer.start_as_current_span("llm_chat_request") as span:
-            span.set_attribute("llm.model", self.model)
-            span.set_attribute("llm.user_message_length", len(user_message))
-            if session_id:
-                span.set_attribute("session.id", session_id)
+            # Skip attribute work when tracing is disabled or the span was sampled out
+            recording = span.is_recording()
+            if recording:
+                span.set_attribute("llm.model", self.model)
+                span.set_attribute("llm.user_message_length", len(user_message))
+                if session_id:
+                    span.set_attribute("session.id", session_id)
             
             try:
                 # Add user message to history
-                self.conversation_history.append({
-                    "role": "user",
-                    "content": user_message
-                })
+                self._append_history("user", user_message)
                 
-                logger.info(f"Processing message: {user_message[:50]}...")
+                if recording and _ENC is not None:
+                    span.set_attribute("llm.prompt_tokens_estimate", self._prompt_tokens_estimate())
+                
+                logger.info("Processing message: %.50s...", user_message)
                 
                 # Call Ollama with observability
-                response = self._call_ollama(user_message)
+                response = self._call_ollama(user_message, span)
+                content = response["content"]
                 
                 # Add assistant response to history
-                self.conversation_history.append({
-                    "role": "assistant",
-                    "content": response["content"]
-                })
+                self._append_history("assistant", content)
                 
                 # Calculate metrics
-                duration_ms = (time.time() - start_time) * 1000
+                duration_ms = (time.perf_counter_ns() - start) / 1e6
                 total_tokens = response.get("total_tokens", 0)
                 prompt_tokens = response.get("prompt_tokens", 0)
                 completion_tokens = response.get("completion_tokens", 0)
                 
                 # Update OpenTelemetry metrics
-                llm_request_counter.add(1, {"model": self.model, "status": "success"})
-                llm_token_counter.add(total_tokens, {"model": self.model, "type": "total"})
-                llm_token_counter.add(prompt_tokens, {"model": self.model, "type": "prompt"})
-                llm_token_counter.add(completion_tokens, {"model": self.model, "type": "completion"})
-                llm_latency_histogram.record(duration_ms, {"model": self.model})
+                llm_request_counter.add(1, self._attrs_ok)
+                llm_token_counter.add(prompt_tokens, self._attrs_prompt)
+                llm_token_counter.add(completion_tokens, self._attrs_completion)
+                llm_latency_histogram.record(duration_ms, self._attrs_model)
                 
                 # Set span attributes
-                span.set_attribute("llm.response_length", len(response["content"]))
-                span.set_attribute("llm.total_tokens", total_tokens)
-                span.set_attribute("llm.prompt_tokens", prompt_tokens)
-                span.set_attribute("llm.completion_tokens", completion_tokens)
-                span.set_attribute("llm.duration_ms", duration_ms)
-                span.set_attribute("llm.status", "success")
+                if recording:
+                    span.set_attributes({
+                        "llm.response_length": len(content),
+                        "llm.total_tokens": total_tokens,
+                        "llm.prompt_tokens": prompt_tokens,
+                        "llm.completion_tokens": completion_tokens,
+                        "llm.duration_ms": duration_ms,
+                        "llm.status": "success",
+                    })
 
                 opik_context.update_current_span( 
                     metadata={
@@ -272,10 +379,10 @@ class OpikObservableChatbot:
                  ##   }]
                 #)
                 
-                logger.info(f"Response generated in {duration_ms:.2f}ms with {total_tokens} tokens")
+                logger.info("Response generated in %.2fms with %d tokens", duration_ms, total_tokens)
                 
                 return {
-                    "response": response["content"],
+                    "response": content,
                     "metadata": {
                         "model": self.model,
                         "duration_ms": duration_ms,
@@ -287,17 +394,18 @@ class OpikObservableChatbot:
                 }
                 
             except Exception as e:
-                duration_ms = (time.time() - start_time) * 1000
+                duration_ms = (time.perf_counter_ns() - start) / 1e6
                 
                 # Update error metrics
                 llm_error_counter.add(1, {"model": self.model, "error_type": type(e).__name__})
-                llm_request_counter.add(1, {"model": self.model, "status": "error"})
+                llm_request_counter.add(1, self._attrs_err)
                 
                 # Update span with error
-                span.set_attribute("llm.status", "error")
-                span.set_attribute("error.type", type(e).__name__)
-                span.set_attribute("error.message", str(e))
-                span.record_exception(e)
+                if recording:
+                    span.set_attribute("llm.status", "error")
+                    span.set_attribute("error.type", type(e).__name__)
+                    span.set_attribute("error.message", str(e))
+                    span.record_exception(e)
                 
                 # Log error to Opik
                 #opik_client.log_traces(
@@ -315,49 +423,148 @@ class OpikObservableChatbot:
                 #    }]
                 #)
                 
-                logger.error(f"Error in chat: {str(e)}", exc_info=True)
+                logger.error("Error in chat: %s", e, exc_info=True)
                 raise
     
-    @track(name="ollama_api_call")
-    def _call_ollama(self, message: str) -> Dict[str, Any]:
-        """Make API call to Ollama with observability"""
+    def _call_ollama(self, message: str, span: trace.Span) -> Dict[str, Any]:
+        """Make API call to Ollama, annotating the caller's span"""
+        recording = span.is_recording()
         
-        with tracer.start_as_current_span("ollama_api") as span:
-            try:
-                response = self.ollama_client.chat(
-                    model=self.model,
-                    messages=self.conversation_history,
-                )
-                
-                # Extract token counts
-                prompt_tokens = response.get("prompt_eval_count", 0)
-                completion_tokens = response.get("eval_count", 0)
-                total_tokens = prompt_tokens + completion_tokens
-                
-                span.set_attribute("llm.prompt_tokens", prompt_tokens)
-                span.set_attribute("llm.completion_tokens", completion_tokens)
-                span.set_attribute("llm.total_tokens", total_tokens)
-                
-                return {
-                    "content": response["message"]["content"],
-                    "total_tokens": total_tokens,
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens
-                }
-                
-            except Exception as e:
-                span.record_exception(e)
-                logger.error(f"Ollama API error: {str(e)}")
-                raise
+        try:
+            # Snapshot the bounded window once; deques are not JSON serializable
+            messages = list(self.conversation_history)
+
+            # Deterministic requests can be answered from the cache without calling the model
+            cache_key = None
+            if self.temperature == 0:
+                cache_key = response_cache_key(self.model, messages, self.temperature)
+                cached_content = self._cache.get(cache_key)
+                if cached_content is not None:
+                    self._cache.move_to_end(cache_key)
+                    if recording:
+                        span.set_attribute("llm.cache_hit", True)
+                    return {
+                        "content": cached_content,
+                        "total_tokens": 0,
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0
+                    }
+            
+            # Only stateless (first-turn) prompts are safe to answer from a paraphrase
+            query_embedding = None
+            if self.temperature == 0 and len(self.conversation_history) == 1:
+                query_embedding = self._embed(message)
+                cached_content = self._semantic_lookup(query_embedding)
+                if cached_content is not None:
+                    if recording:
+                        span.set_attribute("llm.semantic_cache_hit", True)
+                    return {
+                        "content": cached_content,
+                        "total_tokens": 0,
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0
+                    }
+            
+            start = time.perf_counter_ns()
+            stream = self.ollama_client.chat(
+                model=self.model,
+                messages=messages,
+                options=None if self.temperature is None else {"temperature": self.temperature},
+                stream=True,
+            )
+            
+            # Collect streamed tokens, timing the first one
+            content_parts = []
+            first_token_ms = None
+            response = {}
+            for response in stream:
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter_ns() - start) / 1e6
+                    llm_ttft_histogram.record(first_token_ms, self._attrs_model)
+                content_parts.append(response["message"]["content"])
+            content = "".join(content_parts)
+            
+            # Extract token counts (reported on the final chunk)
+            prompt_tokens = response.get("prompt_eval_count", 0)
+            completion_tokens = response.get("eval_count", 0)
+            total_tokens = prompt_tokens + completion_tokens
+            
+            if cache_key is not None:
+                self._cache[cache_key] = content
+                if len(self._cache) > RESPONSE_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+            if query_embedding is not None:
+                self._semantic_store(query_embedding, content)
+            
+            if recording and first_token_ms is not None:
+                span.set_attribute("llm.first_token_ms", first_token_ms)
+            
+            return {
+                "content": content,
+                "total_tokens": total_tokens,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens
+            }
+            
+        except Exception as e:
+            # chat() records the exception on the span
+            logger.error("Ollama API error: %s", e)
+            raise
+    
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Return the unit-length embedding of text, or None if embedding fails"""
+        try:
+            response = self.ollama_client.embed(model=OLLAMA_EMBED_MODEL, input=text)
+        except Exception as e:
+            logger.debug("Embedding failed, skipping semantic cache: %s", e)
+            return None
+        vector = np.asarray(response["embeddings"][0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    
+    def _semantic_lookup(self, query: Optional[np.ndarray]) -> Optional[str]:
+        """Return the cached response most similar to query, if above the threshold"""
+        if query is None or self._emb_matrix is None:
+            return None
+        sims = self._emb_matrix @ query
+        i = int(sims.argmax())
+        if sims[i] > SEMANTIC_CACHE_THRESHOLD:
+            return self._cached_responses[i]
+        return None
+    
+    def _semantic_store(self, query: np.ndarray, content: str):
+        """Add a response to the semantic cache, evicting the oldest when full"""
+        if self._emb_matrix is None:
+            self._emb_matrix = query[np.newaxis, :]
+        else:
+            self._emb_matrix = np.vstack([self._emb_matrix, query])
+        self._cached_responses.append(content)
+        if len(self._cached_responses) > RESPONSE_CACHE_SIZE:
+            self._emb_matrix = self._emb_matrix[1:]
+            self._cached_responses.pop(0)
+    
+    def _append_history(self, role: str, content: str):
+        """Add a message to the history window; it is tokenized only if a recording span needs it"""
+        self.conversation_history.append({"role": role, "content": content})
+        self._history_tokens.append(None)
+    
+    def _prompt_tokens_estimate(self) -> int:
+        """Sum the per-message token counts, tokenizing each message at most once"""
+        counts = self._history_tokens
+        for i, message in enumerate(self.conversation_history):
+            if counts[i] is None:
+                counts[i] = len(_ENC.encode_ordinary(message["content"]))
+        return sum(counts)
     
     def clear_history(self):
         """Clear conversation history"""
-        self.conversation_history = []
+        self.conversation_history.clear()
+        self._history_tokens.clear()
         logger.info("Conversation history cleared")
     
     def get_history(self):
         """Get conversation history"""
-        return self.conversation_history
+        return list(self.conversation_history)
 
 
 # ============================================================================
@@ -383,9 +590,9 @@ def run_demo():
     
     # Initialize chatbot
     chatbot = OpikObservableChatbot(model=OLLAMA_MODEL)
-    session_id = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    session_id = f"session_{secrets.token_hex(8)}"
     
-    logger.info(f"Started demo session: {session_id}")
+    logger.info("Started demo session: %s", session_id)
     
     # Create Opik trace for the entire session
     with tracer.start_as_current_span("chatbot_session") as session_span:
@@ -430,7 +637,7 @@ def run_demo():
                 break
             except Exception as e:
                 print(f"\n❌ Error: {str(e)}")
-                logger.error(f"Demo error: {str(e)}", exc_info=True)
+                logger.error("Demo error: %s", e, exc_info=True)
         
         # Set final session attributes
         session_span.set_attribute("session.total_messages", len(chatbot.get_history()))